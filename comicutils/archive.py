@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import zipfile
+import cStringIO
+from subprocess import Popen, PIPE
+
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+from cmd import APPS, startupinfo
+
+if rarfile is not None:
+    rarfile.UNRAR_TOOL = APPS['rar']
+
+class ZipReader:
+    """ZipReader reads members of ZIP archive."""
+    def __init__(self, src):
+        self._zfile = zipfile.ZipFile(src, 'r')
+
+    def namelist(self):
+        return self._zfile.namelist()
+
+    def read(self, name):
+        return self._zfile.read(name)
+
+    def extractall(self, path):
+        self._zfile.extractall(path)
+
+    def close(self):
+        self._zfile.close()
+
+class RarReader:
+    """RarReader reads members of RAR archive. Archive is listed once
+    and kept open, with rarfile module headers are parsed in-process
+    and stored members are read without external process. Without
+    rarfile the rar executable is used.
+    """
+    def __init__(self, src):
+        self._src = src
+        self._rfile = None
+        if rarfile is not None:
+            self._rfile = rarfile.RarFile(src)
+            self._files = self._rfile.namelist()
+        else:
+            proc = Popen([APPS['rar'], 'vb', src],
+                    stdout=PIPE, stderr=PIPE,
+                    shell=False, startupinfo=startupinfo)
+            stdout, stderr = proc.communicate()
+            self._files = [name.rstrip('\r') for name in stdout.split('\n') if name]
+
+    def namelist(self):
+        return self._files
+
+    def read(self, name):
+        if self._rfile is not None:
+            return self._rfile.read(name)
+        proc = Popen([APPS['rar'], 'p', '-inul', '-p-', '--', self._src, name],
+                stdout=PIPE, stderr=PIPE,
+                shell=False, startupinfo=startupinfo)
+        stdout, stderr = proc.communicate()
+        return stdout
+
+    def extractall(self, path):
+        if self._rfile is not None:
+            self._rfile.extractall(path)
+            return
+        proc = Popen([APPS['rar'], 'x', self._src, path],
+                stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                shell=False, startupinfo=startupinfo)
+        stdout, stderr = proc.communicate()
+        if stderr != '':
+            raise IOError(stderr.strip())
+
+    def close(self):
+        if self._rfile is not None:
+            self._rfile.close()
+
+READERS = {'ZIP': ZipReader, 'RAR': RarReader}
+
+class Extractor:
+    """Extractor is a class for extracting different archive formats.
+    This is a much simplified version of the Extractor class from Comix.
+    Archive is opened once and stays open for listing and extracting
+    several members.
+    """
+    def __init__(self, src, filetype):
+        """Setup the extractor with archive <src> of type <filetype>."""
+        self._src = src
+        self._type = filetype
+        if filetype not in READERS:
+            raise IOError('Unsupported archive type')
+        self._reader = READERS[filetype](src)
+        self._files = self._reader.namelist()
+
+    def get_files(self):
+        """Return a list of the files in the archive."""
+        return self._files
+
+    def extract(self, chosen):
+        """Extract the file <chosen> and return it as a cStringIO.StringIO
+        object. The <chosen> file must be one of the files in the list
+        returned by the get_files() method.
+        """
+        return cStringIO.StringIO(self._reader.read(chosen))
+
+    def extractall(self, path):
+        """Extract all files to directory <path>."""
+        self._reader.extractall(path)
+
+    def close(self):
+        """Close the archive."""
+        self._reader.close()
@@ -1,9 +1,16 @@
 import os
 import sys
+import subprocess
 
 APPS = {}
 BINDIR = os.path.join(sys.path[0], 'bin')
 
+if os.name == 'nt':
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+else:
+    startupinfo = None
+
 def which(prog):
     """ Equivalent of unix which command """
     def is_exe(fpath):
@@ -4,8 +4,8 @@
 import os
 import sys
 import glob
-import time
 import shutil
+import threading
 
 try:
     from PyQt4.QtGui import *
@@ -17,10 +17,14 @@ except ImportError, err:
 try:
     from comicutils.ui.cc_ui import Ui_MainWindow
     from comicutils import utils
+    from comicutils.index import INDEX_PATH
+    from comicutils.progress import ProgressReporter
 except ImportError, err:
     sys.stderr.write("Error: %s%s" % (str(err), os.linesep))
     sys.exit(1)
 
+MESSAGE_TIME = 1000
+
 class ComicConvert(QMainWindow, Ui_MainWindow):
 
     toggle_current = pyqtSignal()
@@ -34,6 +38,11 @@ class ComicConvert(QMainWindow, Ui_MainWindow):
         self.setFixedSize(self.sizeHint())
         self.setWindowFlags((self.windowFlags() | Qt.CustomizeWindowHint) & ~Qt.WindowMaximizeButtonHint)
         self.progressBar.hide()
+        self.opt_jobs.setEnabled(utils.PROCESS_POOL)
+
+        self.message_timer = QTimer(self)
+        self.message_timer.setSingleShot(True)
+        self.pending_message = None
 
         self.set_opts()
         self.model = QStandardItemModel()
@@ -53,14 +62,16 @@ class ComicConvert(QMainWindow, Ui_MainWindow):
                 SIGNAL("valueChanged(int)"), self.on_opt_size_valueChanged)
         self.connect(self.select_lineEdit,
                 SIGNAL("returnPressed()"), self.refresh_treeview)
-        self.connect(self.progressBar,
-                SIGNAL("valueChanged(int)"), self.on_progress_bar_changed)
+        self.connect(self,
+                SIGNAL("progress_value(PyQt_PyObject)"), self.on_progress_bar_changed)
         self.connect(self,
                 SIGNAL("toggle_current(PyQt_PyObject)"), self.on_toggle_current)
         self.connect(self,
                 SIGNAL("show_message(PyQt_PyObject)"), self.on_show_message)
         self.connect(self,
                 SIGNAL("show_progress(PyQt_PyObject)"), self.on_show_progress)
+        self.connect(self.message_timer,
+                SIGNAL("timeout()"), self.on_message_timeout)
         self.connect(self.treeView,
                 SIGNAL("doubleClicked(QModelIndex)"), self.on_double_click)
         self.connect(self,
@@ -85,6 +96,11 @@ class ComicConvert(QMainWindow, Ui_MainWindow):
         self.opts['rar'] = False
         self.opts['zip'] = False
         self.opts['suffix'] = ''
+        self.opts['palette'] = 'page'
+        self.opts['engine'] = 'pil'
+        self.opts['jobs'] = 1
+        self.opts['compress_level'] = 6
+        self.opts['index'] = INDEX_PATH
         self.opts['verbose'] = False
 
     def set_columns(self):
@@ -132,6 +148,7 @@ class ComicConvert(QMainWindow, Ui_MainWindow):
         self.opts['scale'] = str(self.opt_scale.text())
         self.opts['level'] = str(self.opt_level.text())
         self.opts['quality'] = str(self.opt_quality.value())
+        self.opts['jobs'] = self.opt_jobs.value()
 
         if self.opt_exclude.isChecked():
             self.opts['exclude'] = str(self.opt_exclude_list.text()).split(",")
@@ -158,10 +175,25 @@ class ComicConvert(QMainWindow, Ui_MainWindow):
                 index, QItemSelectionModel.ToggleCurrent)
 
     def on_show_message(self, message=None):
+        # every message stays visible for at least MESSAGE_TIME, newer
+        # messages wait for the timer and only the last one is shown
+        if self.message_timer.isActive():
+            self.pending_message = (message,)
+        else:
+            self.display_message(message)
+
+    def on_message_timeout(self):
+        if self.pending_message is not None:
+            message, = self.pending_message
+            self.pending_message = None
+            self.display_message(message)
+
+    def display_message(self, message=None):
         if not message:
             self.statusBar.clearMessage()
         else:
             self.statusBar.showMessage(message)
+            self.message_timer.start(MESSAGE_TIME)
 
     def on_show_progress(self, progress=True):
         if progress:
@@ -193,12 +225,18 @@ class ComicConvert(QMainWindow, Ui_MainWindow):
     @pyqtSignature("")
     def on_convert_pushButton_clicked(self):
         self.get_options()
+        try:
+            utils.Pipeline(self.opts)
+        except ValueError, err:
+            QMessageBox.warning(self, "Error", str(err))
+            return
         self.set_enabled(False)
         self.thread.start()
 
     @pyqtSignature("")
     def on_cancel_pushButton_clicked(self):
-        self.set_enabled(True)
+        # buttons are enabled again when worker finishes
+        self.cancel_pushButton.setEnabled(False)
         self.thread.stop()
 
     @pyqtSignature("")
@@ -253,23 +291,23 @@ class Worker(QThread):
         QThread.__init__(self, parent)
         self.parent = parent
         self.opts = parent.opts
-        self.tmpdir = None
+        self.cancel = threading.Event()
         self.exiting = False
         self.item = None
 
     def __del__(self):
         self.exiting = True
+        self.cancel.set()
         self.wait()
 
     def stop(self):
+        """Cancels conversion, worker stops at the next page or stage,
+        kills running conversions and removes its temporary directory.
+        """
         self.exiting = True
-        self.show_progress(False)
-        self.show_message(None)
-        if self.item:
-            self.item_status(self.item, "")
-        if self.tmpdir:
-            shutil.rmtree(self.tmpdir)
-        self.terminate()
+        self.cancel.set()
+        utils.kill_processes()
+        self.show_message('Cancelling...')
 
     def item_status(self, item, status):
         self.parent.emit(SIGNAL("item_status(PyQt_PyObject, PyQt_PyObject)"), item, status)
@@ -285,12 +323,17 @@ class Worker(QThread):
 
     def run(self):
         self.exiting = False
+        self.cancel.clear()
+        self.item = None
         rowcount = self.parent.model.rowCount()
+        progress = ProgressReporter(self.opts, self.parent)
 
         while not self.exiting:
             for row in range(rowcount):
                 index = self.parent.model.index(row, 0)
                 item = self.parent.model.itemFromIndex(index)
+                if self.cancel.is_set():
+                    break
                 self.item = item
                 self.parent.emit(SIGNAL("toggle_current(PyQt_PyObject)"), index)
                 comic = item.data().toPyObject()
@@ -306,49 +349,58 @@ class Worker(QThread):
                 if os.path.isfile(os.path.join(convdir, filename)):
                     self.show_message('Skipping, file exists in %s' % convdir, row)
                     self.item_status(item, "SKIPPED")
-                    time.sleep(1)
                     continue
 
                 self.show_message('Unpacking file %s (%sMB)...' % (
                     filename, filesize/(1024*1024)), row)
                 self.item_status(item, "UNPACKING...")
                 tempdir = utils.unpack_archive(fullpath, filetype, filename)
-                if tempdir is not None:
-                    self.tmpdir = tempdir
+                if tempdir is None:
+                    continue
+                try:
+                    if self.cancel.is_set():
+                        break
                     self.show_message('File %s unpacked' % filename, row)
                     self.item_status(item, "CONVERTING...")
                     self.parent.emit(SIGNAL("show_progress(PyQt_PyObject)"), True)
 
-                    if utils.convert_images(tempdir, self.opts, self.parent, row):
-                        self.parent.progressBar.emit(SIGNAL("valueChanged(int)"), 0)
-                        self.parent.emit(SIGNAL("show_progress(PyQt_PyObject)"), False)
-                        self.show_message('File %s converted' % filename, row)
-
-                        if not self.opts['outdir'] and not os.path.isdir(convdir):
-                            os.mkdir(convdir)
-
-                        if self.opts['suffix']:
-                            basename = basename + self.opts['suffix']
-                            filename = basename + fileext
-
-                        if self.opts['rar']:
-                            filetype = 'RAR'
-                            filename = '%s.cbr' % basename
-                        elif self.opts['zip']:
-                            filetype = 'ZIP'
-                            filename = '%s.cbz' % basename
-
-                        self.show_message('Packing %s...' % filename, row)
-                        self.item_status(item, "PACKING...")
-                        filepath = os.path.join(convdir, filename)
-                        if utils.pack_archive(tempdir, filetype, filepath):
-                            self.show_message('File %s packed.' % filepath, row)
-                            shutil.rmtree(tempdir)
-
-                        self.item_status(item, "OK")
-                        self.tmpdir = None
-
-            time.sleep(1)
+                    progress.prefix = "File %d of %d -" % (row+1, rowcount)
+                    converted = utils.convert_images(tempdir, self.opts, progress, self.cancel)
+                    progress.reset()
+                    self.parent.emit(SIGNAL("show_progress(PyQt_PyObject)"), False)
+                    if self.cancel.is_set():
+                        break
+                    if not converted:
+                        continue
+                    self.show_message('File %s converted' % filename, row)
+
+                    if not self.opts['outdir'] and not os.path.isdir(convdir):
+                        os.mkdir(convdir)
+
+                    if self.opts['suffix']:
+                        basename = basename + self.opts['suffix']
+                        filename = basename + fileext
+
+                    if self.opts['rar']:
+                        filetype = 'RAR'
+                        filename = '%s.cbr' % basename
+                    elif self.opts['zip']:
+                        filetype = 'ZIP'
+                        filename = '%s.cbz' % basename
+
+                    self.show_message('Packing %s...' % filename, row)
+                    self.item_status(item, "PACKING...")
+                    filepath = os.path.join(convdir, filename)
+                    if utils.pack_archive(tempdir, filetype, filepath,
+                            self.opts['compress_level'], self.opts['jobs']):
+                        self.show_message('File %s packed.' % filepath, row)
+
+                    self.item_status(item, "OK")
+                finally:
+                    shutil.rmtree(tempdir, ignore_errors=True)
+
+            if self.cancel.is_set() and self.item:
+                self.item_status(self.item, "")
             self.show_message(None)
             self.parent.set_enabled(True)
             self.exiting = True
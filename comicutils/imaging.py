@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import math
+import struct
+
+try:
+    from PIL import Image, ImageFile
+except ImportError:
+    try:
+        import Image
+        import ImageFile
+    except ImportError:
+        Image = None
+
+if Image is not None:
+    RESAMPLE = getattr(Image, 'BOX', None) or getattr(Image, 'ANTIALIAS')
+
+GEOMETRY_RE = re.compile(
+        r'^\s*(?P<w>\d+(\.\d+)?)?%?(x(?P<h>\d+(\.\d+)?)?%?)?\s*(?P<flags>[%!<>^@]*)'
+        r'\s*([+-]\d+[+-]\d+)?\s*$')
+
+FORMATS = {
+        '.jpg': 'JPEG', '.jpeg': 'JPEG', '.jpe': 'JPEG',
+        '.png': 'PNG', '.gif': 'GIF', '.bmp': 'BMP',
+        '.tif': 'TIFF', '.tiff': 'TIFF'}
+
+DEPTHS = {'1': 1, 'I;16': 16, 'I': 32, 'F': 32}
+
+def available():
+    """Returns True if PIL can be used for image conversion"""
+    return Image is not None
+
+def scale_size(geometry, size):
+    """Returns new (width, height) for ImageMagick style <geometry>
+    applied to image of given <size>, percents can follow both width
+    and height (200%x50%) or the whole geometry (200x50%). Area is given
+    as <pixels>@, offsets are ignored as they are by -scale.
+    """
+    width, height = size
+    m = GEOMETRY_RE.match(str(geometry))
+    if m is None:
+        raise ValueError('Invalid geometry %s' % geometry)
+    w, h, flags = m.group('w'), m.group('h'), m.group('flags')
+
+    if '%' in str(geometry):
+        sx = float(w) if w else 100.0
+        sy = float(h) if h else sx
+        return (max(1, int(round(width * sx / 100.0))),
+                max(1, int(round(height * sy / 100.0))))
+
+    if '@' in flags:
+        if not w:
+            raise ValueError('Invalid geometry %s' % geometry)
+        ratio = math.sqrt(float(w) / (width * height))
+    elif w and h:
+        w, h = float(w), float(h)
+        if '!' in flags:
+            return (max(1, int(w)), max(1, int(h)))
+        if '^' in flags:
+            ratio = max(w / width, h / height)
+        else:
+            ratio = min(w / width, h / height)
+    elif w:
+        ratio = float(w) / width
+    elif h:
+        ratio = float(h) / height
+    else:
+        return size
+
+    if '>' in flags and ratio >= 1.0:
+        return size
+    if '<' in flags and ratio <= 1.0:
+        return size
+    return (max(1, int(round(width * ratio))),
+            max(1, int(round(height * ratio))))
+
+def palette_colorspace(palette):
+    """Returns 'Gray' if all entries of RGB <palette> are gray"""
+    for i in range(0, len(palette) - 2, 3):
+        if not palette[i] == palette[i+1] == palette[i+2]:
+            return 'RGB'
+    return 'Gray'
+
+def colorspace(im):
+    """Returns colorspace name of <im> the way identify reports it"""
+    if im.mode in ('1', 'L', 'LA', 'I', 'I;16', 'F'):
+        return 'Gray'
+    elif im.mode == 'CMYK':
+        return 'CMYK'
+    elif im.mode == 'P':
+        if getattr(im.palette, 'rawmode', None) == 'RGB':
+            # palette read from header, image does not have to be decoded
+            return palette_colorspace(bytearray(im.palette.palette))
+        return palette_colorspace(im.getpalette() or [])
+    return 'RGB'
+
+def header_info(fileobj):
+    """Returns (colorspace, width, height, format, depth) of image, only
+    the header is read and pixels are not decoded.
+    """
+    im = Image.open(fileobj)
+    width, height = im.size
+    return colorspace(im), width, height, im.format, DEPTHS.get(im.mode, 8)
+
+def sample_bits(im):
+    """Returns bits per sample of 16bit or 32bit gray image <im>"""
+    if im.mode.startswith('I;16'):
+        return 16
+    tags = getattr(im, 'tag_v2', None) or getattr(im, 'tag', None)
+    if im.format == 'TIFF' and tags is not None and 258 in tags:
+        bits = tags[258]
+        if isinstance(bits, tuple):
+            bits = bits[0]
+        return int(bits)
+    # PIL opens 16bit PNG images in I mode
+    return 16
+
+def normalize(im):
+    """Returns 16bit and 32bit gray <im> rescaled to 8bit L mode the way
+    ImageMagick does, integer samples are scaled from their full range
+    and floating point samples from 0-1 range. Other images are
+    returned as they are.
+    """
+    if im.mode == 'F':
+        factor = 255.0
+    elif im.mode == 'I' or im.mode.startswith('I;16'):
+        factor = 255.0 / ((1 << sample_bits(im)) - 1)
+        if im.mode != 'I':
+            im = im.convert('I')
+    else:
+        return im
+    return im.point(lambda v: v * factor).convert('L')
+
+def open_image(fullpath):
+    """Opens and decodes image, palette and bilevel images are expanded
+    so they can be resampled with a proper filter, high bit depth gray
+    images are reduced to 8bit.
+    """
+    im = Image.open(fullpath)
+    im.load()
+    fmt = im.format
+    im = normalize(im)
+    if im.mode in ('1', 'P'):
+        if colorspace(im) == 'Gray':
+            im = im.convert('L')
+        else:
+            im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+    return im, fmt
+
+def scale(im, geometry):
+    """Returns <im> scaled to ImageMagick style <geometry>"""
+    size = scale_size(geometry, im.size)
+    if size == im.size:
+        return im
+    return im.resize(size, RESAMPLE)
+
+QUANTUM_RANGE = 65535.0
+
+LEVEL_RE = re.compile(r'[,x/\s]+')
+
+def level_values(level):
+    """Returns (black, white, gamma) for ImageMagick -level argument
+    black[,white][,gamma], black and white are in percents if argument
+    has %, otherwise in Q16 quantum range. If white is not given it is
+    QuantumRange - black, like in ImageMagick.
+    """
+    level = str(level).strip()
+    try:
+        values = [float(v) for v in LEVEL_RE.split(level.replace('%', '')) if v]
+    except ValueError:
+        values = None
+    if not values or len(values) > 3:
+        raise ValueError('Invalid level %s' % level)
+    black = values[0]
+    white = values[1] if len(values) > 1 else None
+    gamma = values[2] if len(values) > 2 else 1.0
+    if '%' in level:
+        black = black * QUANTUM_RANGE / 100.0
+        if white is not None:
+            white = white * QUANTUM_RANGE / 100.0
+    if white is None:
+        white = QUANTUM_RANGE - black
+    return black, white, gamma
+
+_level_tables = {}
+
+def level_table(level):
+    """Returns 256 entries lookup table for -level argument, table is
+    computed once for every argument.
+    """
+    if level in _level_tables:
+        return _level_tables[level]
+    black, white, gamma = level_values(level)
+    if white == black:
+        scale = 1.0 / 1.0e-12
+    else:
+        scale = 1.0 / (white - black)
+    table = []
+    for i in range(256):
+        v = scale * (i * QUANTUM_RANGE / 255.0 - black)
+        if v > 0.0 and gamma != 1.0:
+            v = v ** (1.0 / gamma)
+        table.append(int(round(min(1.0, max(0.0, v)) * 255)))
+    _level_tables[level] = table
+    return table
+
+def level(im, level):
+    """Returns <im> with contrast levels adjusted"""
+    table = level_table(level)
+    im = normalize(im)
+    if im.mode in ('LA', 'RGBA'):
+        bands = im.split()
+        bands = [b.point(table) for b in bands[:-1]] + [bands[-1]]
+        return Image.merge(im.mode, bands)
+    return im.point(table * len(im.getbands()))
+
+def quantize_palette(im, colors):
+    """Returns palette image of <im> reduced to <colors> colors"""
+    return normalize(im).convert('RGB').quantize(colors)
+
+def gray_palette(colors):
+    """Returns palette of <colors> evenly spaced gray levels"""
+    palette = []
+    for i in range(colors):
+        palette += [i * 255 / (colors - 1)] * 3
+    return palette
+
+_gray_tables = {}
+
+def gray_table(colors):
+    """Returns lookup table from gray value to index in gray_palette"""
+    if colors not in _gray_tables:
+        _gray_tables[colors] = [int(round(v * (colors - 1) / 255.0)) for v in range(256)]
+    return _gray_tables[colors]
+
+def map_gray(im, colors):
+    """Returns palette image of <im> with gray levels mapped to
+    gray_palette(colors) through lookup table.
+    """
+    im = normalize(im).convert('L').point(gray_table(colors))
+    im.putpalette(gray_palette(colors))
+    return im
+
+def mosaic(sources, size=64):
+    """Returns one image with all images in <sources> resized to <size>
+    pixels square, or None if no image could be read.
+    """
+    tiles = []
+    for source in sources:
+        try:
+            im = Image.open(source)
+            im.draft('RGB', (size, size))
+            tiles.append(normalize(im).convert('RGB').resize((size, size)))
+        except (EnvironmentError, ValueError):
+            pass
+    if not tiles:
+        return None
+    im = Image.new('RGB', (size * len(tiles), size))
+    for i, tile in enumerate(tiles):
+        im.paste(tile, (i * size, 0))
+    return im
+
+def sample_palette(im, colors):
+    """Returns palette of <colors> colors computed from <im>"""
+    return im.convert('RGB').quantize(colors).getpalette()[:colors * 3]
+
+def map_palette(im, palette):
+    """Returns palette image of <im> mapped to fixed <palette>"""
+    # unused entries repeat the first color, on ties PIL picks the
+    # lowest index so pixels never map outside of palette
+    pal = Image.new('P', (1, 1))
+    pal.putpalette(palette + palette[:3] * (256 - len(palette) / 3))
+    return normalize(im).convert('RGB').quantize(palette=pal)
+
+def save_bmp(im, fileobj, depth):
+    """Encodes palette image <im> to <fileobj> as 4bit or 8bit BMP,
+    rows are packed and written by PIL encoder without copy of the
+    whole image.
+    """
+    width, height = im.size
+    entries = 1 << depth
+    stride = ((width * depth + 31) / 32) * 4
+    palette = bytearray(im.getpalette()[:entries * 3])
+    palette += bytearray(entries * 3 - len(palette))
+    colors = ''.join([chr(palette[i+2]) + chr(palette[i+1]) + chr(palette[i]) + '\0'
+            for i in range(0, entries * 3, 3)])
+    offset = 14 + 40 + len(colors)
+    fileobj.write(struct.pack('<2sIHHI', 'BM', offset + stride * height, 0, 0, offset))
+    fileobj.write(struct.pack('<IiiHHIIiiII', 40, width, height, 1, depth,
+            0, stride * height, 2835, 2835, entries, 0))
+    fileobj.write(colors)
+    rawmode = 'P;4' if depth == 4 else 'P'
+    ImageFile._save(im, fileobj,
+            [('raw', (0, 0, width, height), 0, (rawmode, stride, -1))])
+
+def save_image(im, fileobj, fmt, quality='0'):
+    """Encodes <im> to <fileobj> in given format"""
+    im = normalize(im)
+    params = {}
+    if fmt == 'JPEG':
+        if im.mode not in ('L', 'RGB', 'CMYK'):
+            im = im.convert('RGB')
+        params['quality'] = int(quality) or 92
+    elif fmt in ('BMP', 'PPM') and im.mode not in ('1', 'L', 'P', 'RGB'):
+        im = im.convert('RGB')
+    im.save(fileobj, fmt, **params)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+from stat import ST_SIZE, ST_MTIME
+
+INDEX_PATH = os.path.expanduser('~/.cache/comic-utils/index.db')
+
+class ScanIndex:
+    """ScanIndex is a persistent index of scanned archives, keyed by
+    path with size, mtime and detected archive type. Archives are
+    sniffed again only if their size or mtime changed. Index can be
+    used from several threads, but not at the same time.
+    """
+    def __init__(self, path=INDEX_PATH):
+        """Open or create index database <path>."""
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS comics (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                type TEXT)""")
+
+    def get_type(self, fullpath, st, sniff):
+        """Return archive type of <fullpath> with stat result <st>.
+        The <sniff> function is called to detect the type only when
+        file is not in the index or was changed.
+        """
+        row = self._conn.execute(
+                "SELECT size, mtime, type FROM comics WHERE path = ?",
+                (fullpath,)).fetchone()
+        if row is not None:
+            size, mtime, filetype = row
+            if size == st[ST_SIZE] and mtime == int(st[ST_MTIME]):
+                return filetype
+        filetype = sniff(fullpath)
+        self._conn.execute(
+                "INSERT OR REPLACE INTO comics VALUES (?, ?, ?, ?)",
+                (fullpath, st[ST_SIZE], int(st[ST_MTIME]), filetype))
+        return filetype
+
+    def close(self):
+        """Commit changes and close the index."""
+        self._conn.commit()
+        self._conn.close()
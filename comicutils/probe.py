@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Image headers are parsed here without PIL, only the bytes needed to
+# reach the header are read, so zip member streams can be probed too.
+
+import struct
+
+CHUNK_SIZE = 8192
+
+# JPEG start of frame markers, DHT, JPG and DAC are excluded
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+JPEG_COLORS = {1: 'Gray', 3: 'RGB', 4: 'CMYK'}
+PNG_COLORS = {0: 'Gray', 2: 'RGB', 4: 'Gray', 6: 'RGB'}
+TIFF_COLORS = {0: 'Gray', 1: 'Gray', 2: 'RGB', 5: 'CMYK', 6: 'RGB', 8: 'RGB'}
+
+# TIFF field type sizes and struct formats
+TIFF_TYPES = {3: (2, 'H'), 4: (4, 'I')}
+
+class Reader:
+    """Reader gives random access to the beginning of a string or a
+    file object that can only be read forward, bytes read from file
+    are kept in memory.
+    """
+    def __init__(self, source):
+        if isinstance(source, str):
+            self._data = source
+            self._fileobj = None
+        else:
+            self._data = ''
+            self._fileobj = source
+
+    def at(self, offset, size):
+        """Returns <size> bytes at <offset>, raises ValueError if
+        there is not enough data.
+        """
+        end = offset + size
+        while len(self._data) < end and self._fileobj is not None:
+            chunk = self._fileobj.read(max(CHUNK_SIZE, end - len(self._data)))
+            if not chunk:
+                self._fileobj = None
+                break
+            self._data += chunk
+        if len(self._data) < end:
+            raise ValueError('Truncated image header')
+        return self._data[offset:end]
+
+    def unpack(self, fmt, offset):
+        """Returns values of struct <fmt> at <offset>"""
+        return struct.unpack(fmt, self.at(offset, struct.calcsize(fmt)))
+
+def palette_colorspace(palette, step=3):
+    """Returns 'Gray' if all entries of <palette> are gray, entries
+    are <step> bytes long and start with three color bytes.
+    """
+    palette = bytearray(palette)
+    for i in range(0, len(palette) - 2, step):
+        if not palette[i] == palette[i+1] == palette[i+2]:
+            return 'RGB'
+    return 'Gray'
+
+def probe_jpeg(r):
+    offset = 2
+    while True:
+        marker = bytearray(r.at(offset, 2))
+        if marker[0] != 0xFF:
+            raise ValueError('Invalid JPEG marker')
+        if marker[1] == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        if marker[1] in (0x01, 0xD8) or 0xD0 <= marker[1] <= 0xD7:
+            # markers without length
+            offset += 2
+            continue
+        if marker[1] in (0xD9, 0xDA):
+            raise ValueError('JPEG frame header not found')
+        length, = r.unpack('>H', offset + 2)
+        if marker[1] in SOF_MARKERS:
+            depth, height, width, components = r.unpack('>BHHB', offset + 4)
+            return JPEG_COLORS.get(components, 'RGB'), width, height, 'JPEG', depth
+        offset += 2 + length
+
+def probe_png(r):
+    width, height, depth, colortype = r.unpack('>IIBB', 16)
+    if colortype != 3:
+        return PNG_COLORS.get(colortype, 'RGB'), width, height, 'PNG', depth
+    offset = 8
+    while True:
+        length, ctype = r.unpack('>I4s', offset)
+        if ctype == 'PLTE':
+            color = palette_colorspace(r.at(offset + 8, length))
+            return color, width, height, 'PNG', depth
+        if ctype in ('IDAT', 'IEND'):
+            raise ValueError('PNG palette not found')
+        offset += 12 + length
+
+def probe_gif(r):
+    width, height, flags = r.unpack('<HHB', 6)
+    color = 'RGB'
+    if flags & 0x80:
+        entries = 2 << (flags & 7)
+        color = palette_colorspace(r.at(13, entries * 3))
+    return color, width, height, 'GIF', 8
+
+def probe_bmp(r):
+    dibsize, = r.unpack('<I', 14)
+    if dibsize == 12:
+        width, height, planes, bpp = r.unpack('<HHHH', 18)
+        colors, step = 0, 3
+    else:
+        width, height, planes, bpp = r.unpack('<iiHH', 18)
+        colors, = r.unpack('<I', 46)
+        step = 4
+    height = abs(height)
+    depth = 1 if bpp == 1 else 8
+    if bpp > 8:
+        return 'RGB', width, height, 'BMP', depth
+    entries = colors or 1 << bpp
+    # palette entries are BGR, gray test does not depend on order
+    color = palette_colorspace(r.at(14 + dibsize, entries * step), step)
+    return color, width, height, 'BMP', depth
+
+def probe_tiff(r):
+    order = '<' if r.at(0, 2) == 'II' else '>'
+    offset, = r.unpack(order + 'I', 4)
+    entries, = r.unpack(order + 'H', offset)
+    tags = {}
+    for i in range(entries):
+        tag, ftype, count = r.unpack(order + 'HHI', offset + 2 + i * 12)
+        if ftype not in TIFF_TYPES:
+            continue
+        size, fmt = TIFF_TYPES[ftype]
+        value = offset + 10 + i * 12
+        if size * count > 4:
+            value, = r.unpack(order + 'I', value)
+        tags[tag] = (value, count, fmt)
+
+    def first(tag, default=None):
+        if tag not in tags:
+            return default
+        value, count, fmt = tags[tag]
+        return r.unpack(order + fmt, value)[0]
+
+    width, height = first(256), first(257)
+    if width is None or height is None:
+        raise ValueError('TIFF image size not found')
+    depth = first(258, 1)
+    photometric = first(262, 1)
+    if photometric == 3:
+        color = 'RGB'
+        if 320 in tags:
+            value, count, fmt = tags[320]
+            cmap = r.unpack('%s%d%s' % (order, count, fmt), value)
+            n = count / 3
+            color = 'Gray'
+            for i in range(n):
+                if not cmap[i] == cmap[n+i] == cmap[2*n+i]:
+                    color = 'RGB'
+                    break
+    else:
+        color = TIFF_COLORS.get(photometric, 'RGB')
+    return color, width, height, 'TIFF', depth
+
+def probe(source):
+    """Returns (colorspace, width, height, format, depth) read from the
+    image header in <source>, a string or file object. Returns None if
+    format is not known or header is broken.
+    """
+    r = Reader(source)
+    try:
+        magic = r.at(0, 8)
+        if magic[:3] == '\xff\xd8\xff':
+            return probe_jpeg(r)
+        elif magic == '\x89PNG\r\n\x1a\n':
+            return probe_png(r)
+        elif magic[:6] in ('GIF87a', 'GIF89a'):
+            return probe_gif(r)
+        elif magic[:2] == 'BM':
+            return probe_bmp(r)
+        elif magic[:4] in ('II*\0', 'MM\0*'):
+            return probe_tiff(r)
+    except (ValueError, struct.error):
+        pass
+    return None
+
+def probe_file(filepath):
+    """Returns probe() result for image file <filepath>"""
+    fileobj = open(filepath, 'rb')
+    try:
+        return probe(fileobj)
+    finally:
+        fileobj.close()
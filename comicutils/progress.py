@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import threading
+
+try:
+    from PyQt4.QtCore import SIGNAL
+except ImportError, err:
+    pass
+
+FRAME_RATE = 10
+
+class ProgressReporter:
+    """ProgressReporter reports converted pages to the terminal and to
+    the GUI. Updates can come from several threads, they are coalesced
+    and reported at most FRAME_RATE times per second.
+    """
+    def __init__(self, opts, parent=None, rate=FRAME_RATE):
+        """Setup the reporter, progress is written to stderr if verbose
+        is set in <opts> and signalled to GUI window <parent>.
+        """
+        self.verbose = opts['verbose']
+        self.parent = parent
+        self.interval = 1.0 / rate
+        self.prefix = ''
+        self._lock = threading.Lock()
+        self._total = 0
+        self._done = 0
+        self._last = 0.0
+
+    def start(self, total):
+        """Start reporting progress of <total> pages"""
+        with self._lock:
+            self._total = total
+            self._done = 0
+            self._last = 0.0
+
+    def update(self, count=1):
+        """Add <count> done pages, progress is reported only if enough
+        time passed since the last report or all pages are done.
+        """
+        with self._lock:
+            self._done += count
+            now = time.time()
+            if self._done < self._total and now - self._last < self.interval:
+                return
+            self._last = now
+            self._report(self._done, self._total)
+
+    def reset(self):
+        """Reset progress bar in GUI"""
+        if self.parent:
+            self.parent.emit(SIGNAL("progress_value(PyQt_PyObject)"), 0)
+
+    def _report(self, done, total):
+        percent = int(float(done) / float(max(1, total)) * 100)
+        if self.verbose:
+            sys.stderr.write('Converting images [%d%%]\r' % percent)
+        if self.parent:
+            self.parent.emit(SIGNAL("progress_value(PyQt_PyObject)"), percent)
+            self.parent.emit(SIGNAL("show_message(PyQt_PyObject)"),
+                    "%s Converting images [%d%%]" % (self.prefix, percent))
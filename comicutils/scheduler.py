@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from debug import log
+
+class Scheduler:
+    """Scheduler runs jobs on a bounded pool of worker threads. Every
+    named stage of a job has its own concurrency limit, so archives can
+    be unpacked and packed while others are converted. On Ctrl-C no new
+    jobs are started, cancel event is set for running jobs and workers
+    are joined, so jobs can clean up after themselves.
+    """
+    def __init__(self, workers=1, limits=None, on_cancel=None):
+        """Setup the scheduler with <workers> threads and <limits>,
+        a dict of stage name and maximum number of jobs in that stage.
+        <on_cancel> is called until workers finish after cancel event
+        is set on Ctrl-C.
+        """
+        self.workers = max(1, workers)
+        self.exiting = False
+        self.cancel = threading.Event()
+        self.on_cancel = on_cancel
+        self._lock = threading.Lock()
+        self._stages = {}
+        for name, limit in (limits or {}).items():
+            self._stages[name] = threading.BoundedSemaphore(
+                    max(1, limit or self.workers))
+
+    def stage(self, name):
+        """Returns semaphore to be held while job is in stage <name>"""
+        return self._stages[name]
+
+    def run(self, func, jobs):
+        """Call func(job) for every job from iterable <jobs>"""
+        jobs = iter(jobs)
+        if self.workers == 1:
+            for job in jobs:
+                if self.exiting:
+                    break
+                func(job)
+            return
+
+        def next_job():
+            with self._lock:
+                if self.exiting:
+                    return None
+                try:
+                    return (next(jobs),)
+                except StopIteration:
+                    return None
+
+        def worker():
+            while True:
+                job = next_job()
+                if job is None:
+                    return
+                try:
+                    func(job[0])
+                except Exception, err:
+                    log.Warn('Error: %s %s' % (str(type(err)), str(err)))
+
+        threads = [threading.Thread(target=worker) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._join(threads)
+        except KeyboardInterrupt:
+            self.exiting = True
+            self.cancel.set()
+            self._join(threads)
+            raise
+
+    def _join(self, threads):
+        for thread in threads:
+            while thread.isAlive():
+                if self.cancel.is_set() and self.on_cancel is not None:
+                    self.on_cancel()
+                thread.join(0.5)
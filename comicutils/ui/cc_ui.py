@@ -355,6 +355,14 @@ class Ui_MainWindow(object):
         self.opt_level.setStyleSheet(_fromUtf8("background-image: url(:/res/images/tile.png);"))
         self.opt_level.setObjectName(_fromUtf8("opt_level"))
         self.horizontalLayout_3.addWidget(self.opt_level)
+        self.label_13 = QtGui.QLabel(self.groupBox_3)
+        self.label_13.setObjectName(_fromUtf8("label_13"))
+        self.horizontalLayout_3.addWidget(self.label_13)
+        self.opt_jobs = QtGui.QSpinBox(self.groupBox_3)
+        self.opt_jobs.setMinimum(1)
+        self.opt_jobs.setMaximum(64)
+        self.opt_jobs.setObjectName(_fromUtf8("opt_jobs"))
+        self.horizontalLayout_3.addWidget(self.opt_jobs)
         self.verticalLayout_4.addLayout(self.horizontalLayout_3)
         self.verticalLayout_8.addLayout(self.verticalLayout_4)
         self.horizontalLayout_4.addWidget(self.groupBox_3)
@@ -412,6 +420,7 @@ class Ui_MainWindow(object):
         self.label_4.setBuddy(self.opt_scale)
         self.label_5.setBuddy(self.opt_quality)
         self.label_6.setBuddy(self.opt_level)
+        self.label_13.setBuddy(self.opt_jobs)
 
         self.retranslateUi(MainWindow)
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
@@ -480,6 +489,9 @@ class Ui_MainWindow(object):
         self.label_6.setToolTip(QtGui.QApplication.translate("MainWindow", "adjust the level of image contrast", None, QtGui.QApplication.UnicodeUTF8))
         self.label_6.setText(QtGui.QApplication.translate("MainWindow", "level", None, QtGui.QApplication.UnicodeUTF8))
         self.opt_level.setToolTip(QtGui.QApplication.translate("MainWindow", "Adjust the level of image contrast", None, QtGui.QApplication.UnicodeUTF8))
+        self.label_13.setToolTip(QtGui.QApplication.translate("MainWindow", "number of images converted or compressed at the same time", None, QtGui.QApplication.UnicodeUTF8))
+        self.label_13.setText(QtGui.QApplication.translate("MainWindow", "jobs", None, QtGui.QApplication.UnicodeUTF8))
+        self.opt_jobs.setToolTip(QtGui.QApplication.translate("MainWindow", "Number of images converted or compressed at the same time", None, QtGui.QApplication.UnicodeUTF8))
         self.close_pushButton.setText(QtGui.QApplication.translate("MainWindow", "Close", None, QtGui.QApplication.UnicodeUTF8))
         self.about_pushButton.setText(QtGui.QApplication.translate("MainWindow", "&About", None, QtGui.QApplication.UnicodeUTF8))
         self.cancel_pushButton.setText(QtGui.QApplication.translate("MainWindow", "&Cancel", None, QtGui.QApplication.UnicodeUTF8))
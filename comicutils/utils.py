@@ -21,30 +21,45 @@
 import os
 import sys
 import re
+import zlib
 import zipfile
+import posixpath
+import itertools
+import shutil
 import tempfile
+import time
 import urllib
+import cStringIO
 import math
+import struct
+import signal
+import errno
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import ctypes as ct
 from ctypes.util import find_library
-import subprocess
 from subprocess import Popen, PIPE
-from stat import ST_SIZE, ST_MTIME
-
-if os.name == 'nt':
-    startupinfo = subprocess.STARTUPINFO()
-    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-else:
-    startupinfo = None
+import sqlite3
+from stat import ST_SIZE, ST_MTIME, ST_MODE, S_ISREG, S_ISDIR, S_ISLNK
 
 try:
-    from PyQt4.QtCore import SIGNAL
-except ImportError, err:
-    pass
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 try:
     from debug import log
-    from cmd import APPS
+    from cmd import APPS, startupinfo
+    from archive import Extractor
+    import imaging
+    from index import ScanIndex
+    from progress import ProgressReporter
+    import probe
 except ImportError:
     sys.stderr.write("Can't import comicutils module\r\nExiting...\r\n")
     sys.exit(1)
@@ -57,10 +72,18 @@ class GStringData(ct.Structure):
 lib_path = find_library("glib-2.0")
 GStringDataPointer = ct.POINTER(GStringData)
 
+PNG_MAGIC = '\x89PNG\r\n\x1a\n'
+
+# multiprocessing on Windows imports __main__ in every worker by module
+# name, scripts without .py extension can't be imported, pages are then
+# converted in this process unless program is frozen
+PROCESS_POOL = os.name != 'nt' or getattr(sys, 'frozen', False)
+
 REC_RE = re.compile("\d+|\D+")
 CB_RE = re.compile(r'^.*\.(cbr|cbz)$', re.IGNORECASE)
 FRONT_RE = re.compile('(cover|front)', re.IGNORECASE)
 IMG_RE = re.compile(r'^.*\.(jpg|jpeg|jpe|png|gif|bmp|tif|tiff)\s*$', re.IGNORECASE)
+STORED_RE = re.compile(r'^.*\.(jpg|jpeg|jpe|png|gif)\s*$', re.IGNORECASE)
 
 def djb_hash(s):
     """Returns the value of DJB's hash function for the given 8-bit string."""
@@ -69,33 +92,110 @@ def djb_hash(s):
         h = (((h << 5) + h) ^ ord(c)) & 0xffffffff
     return h
 
+def g_str_hash_py(s):
+    """Returns the value of glib g_string_hash for the given 8-bit string,
+    chars are signed like gchar on most platforms.
+    """
+    h = 0
+    for c in s:
+        c = ord(c)
+        if c > 127:
+            c -= 256
+        h = (h * 31 + c) & 0xffffffff
+    return h
+
+_glib = None
+
+def get_glib():
+    """Returns glib library with g_string prototypes set, or False if
+    glib is not available. Library is loaded only once.
+    """
+    global _glib
+    if _glib is None:
+        try:
+            dll = ct.CDLL(lib_path)
+            dll.g_string_new.argtypes = [ct.c_char_p]
+            dll.g_string_new.restype = GStringDataPointer
+            dll.g_string_hash.argtypes = [GStringDataPointer]
+            dll.g_string_hash.restype = ct.c_uint
+            dll.g_string_free.argtypes = [GStringDataPointer, ct.c_int]
+            dll.g_string_free.restype = ct.c_void_p
+            _glib = dll
+        except (OSError, TypeError, AttributeError):
+            _glib = False
+    return _glib
+
 def g_str_hash(key):
     """Returns glib g_string_hash"""
-    dll = ct.CDLL(lib_path)
-    dll.g_string_new.argtypes = [ct.c_char_p]
-    dll.g_string_new.restype = GStringDataPointer
-    dll.g_string_hash.argtypes = [GStringDataPointer]
-    dll.g_string_hash.restype = ct.c_uint
+    dll = get_glib()
+    if not dll:
+        return g_str_hash_py(key)
     string = dll.g_string_new(key)
-    return dll.g_string_hash(string)
+    try:
+        return dll.g_string_hash(string)
+    finally:
+        dll.g_string_free(string, 1)
 
 def get_mime_type(filepath):
     """Returns mime type of archive file"""
+    if not os.path.isfile(filepath) or not os.access(filepath, os.R_OK):
+        return None
+    return sniff_mime_type(filepath)
+
+def sniff_mime_type(filepath):
+    """Returns mime type of archive file <filepath> already known to be
+    a regular file, type is read from the file without stat calls.
+    """
     try:
-        if os.path.isfile(filepath):
-            if not os.access(filepath, os.R_OK):
-                return None
-            if zipfile.is_zipfile(filepath):
+        fd = open(filepath, 'rb')
+        try:
+            if zipfile.is_zipfile(fd):
                 return 'ZIP'
-            fd = open(filepath, 'rb')
-            magic = fd.read(4)
-            fd.close()
-            if magic == 'Rar!':
+            fd.seek(0)
+            if fd.read(4) == 'Rar!':
                 return 'RAR'
+        finally:
+            fd.close()
+    except IOError, err:
+        if err.errno != errno.EACCES:
+            sys.stderr.write('Error reading %s\n' % (filepath))
     except Exception:
         sys.stderr.write('Error reading %s\n' % (filepath))
     return None
 
+def png_text(filepath):
+    """Returns dict of PNG text chunks, only chunks before image data
+    are read so the image itself is never decoded.
+    """
+    text = {}
+    fd = open(filepath, 'rb')
+    try:
+        if fd.read(8) != PNG_MAGIC:
+            return text
+        while True:
+            header = fd.read(8)
+            if len(header) < 8:
+                break
+            length, ctype = struct.unpack('>I4s', header)
+            if ctype in ('IDAT', 'IEND'):
+                break
+            if ctype in ('tEXt', 'zTXt', 'iTXt'):
+                data = fd.read(length)
+                key, sep, value = data.partition('\0')
+                if ctype == 'zTXt':
+                    value = zlib.decompress(value[1:])
+                elif ctype == 'iTXt':
+                    flag, value = value[:1], value[2:].split('\0', 2)[-1]
+                    if flag == '\1':
+                        value = zlib.decompress(value)
+                text[key] = value
+                fd.seek(4, os.SEEK_CUR)
+            else:
+                fd.seek(length + 4, os.SEEK_CUR)
+    finally:
+        fd.close()
+    return text
+
 def get_file_uri(filepath):
     """Returns file path uri"""
     return "%s%s" % ('file://', urllib.quote(filepath, safe="%/:=&?~+!$,;'@()*"))
@@ -104,17 +204,91 @@ def uri_to_file(filepath):
     """Convert file uri to file path """
     return "%s" % urllib.unquote(filepath).replace('file://', '')
 
-def get_comics(path_args, opts, size=None):
-    """Returns list of comic archives for given path arguments"""
-    comics = []
+class DirEntry:
+    """DirEntry is a minimal replacement for scandir DirEntry, used when
+    scandir is not available. Entry is lstat'ed only once, symlinks are
+    also stat'ed once to follow them.
+    """
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._lstat = None
+        self._stat = None
+
+    def lstat(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def stat(self):
+        if self._stat is None:
+            st = self.lstat()
+            if S_ISLNK(st[ST_MODE]):
+                st = os.stat(self.path)
+            self._stat = st
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            if follow_symlinks:
+                return S_ISDIR(self.stat()[ST_MODE])
+            return S_ISDIR(self.lstat()[ST_MODE])
+        except OSError:
+            return False
+
+def list_dir(path, ordered=True):
+    """Returns entries of directory <path>, alphanumerically sorted
+    if <ordered> is True.
+    """
+    if scandir is not None:
+        entries = scandir(path)
+    else:
+        entries = (DirEntry(path, name) for name in os.listdir(path))
+    if ordered:
+        entries = list(entries)
+        entries.sort(key=lambda entry: alphanumeric_key(entry.name))
+    return entries
+
+def walk_dir(path, recursive=False, ordered=True):
+    """Yields entries of files in directory <path>, files of directory
+    come first and then files of its subdirectories.
+    """
+    try:
+        entries = list_dir(path, ordered)
+    except OSError:
+        return
+    dirs = []
+    for entry in entries:
+        if recursive and entry.is_dir(follow_symlinks=False):
+            dirs.append(entry.path)
+        else:
+            yield entry
+    for dirpath in dirs:
+        for entry in walk_dir(dirpath, recursive, ordered):
+            yield entry
+
+def iter_comics(path_args, opts, size=None, ordered=False):
+    """Yields comic archives for given path arguments while directories
+    are walked. Every file is stat'ed at most once and archives smaller
+    than <size> are skipped before they are opened. Archives are yielded
+    in directory order, or alphanumerically sorted if <ordered> is True.
+    """
+    index = None
+    if opts['index']:
+        try:
+            index = ScanIndex(opts['index'])
+        except (EnvironmentError, sqlite3.Error), err:
+            log.Warn('Error opening index %s: %s' % (opts['index'], str(err)))
 
-    def get_file_info(fullpath):
+    def get_file_info(fullpath, st):
         filename = os.path.basename(fullpath)
         basename, fileext = os.path.splitext(filename)
         filedir = os.path.dirname(fullpath)
         fileuri = get_file_uri(fullpath)
-        filetype = get_mime_type(fullpath)
-        st = os.stat(fullpath)
+        if index is not None:
+            filetype = index.get_type(fullpath, st, sniff_mime_type)
+        else:
+            filetype = sniff_mime_type(fullpath)
         filesize = st[ST_SIZE]
         filemtime = st[ST_MTIME]
         return (filename, basename, fileext, filedir, fullpath, filetype, filesize, filemtime, fileuri)
@@ -127,39 +301,40 @@ def get_comics(path_args, opts, size=None):
             return True
         return False
 
+    def get_stat(entry):
+        try:
+            st = entry.stat()
+        except OSError:
+            return None
+        if S_ISREG(st[ST_MODE]) and is_size(st[ST_SIZE], size):
+            return st
+        return None
+
+    path_args = list(path_args)
     alphanumeric_sort(path_args)
-    for path in path_args:
-        path = os.path.realpath(path)
-
-        if os.path.isfile(path):
-            filepath = path
-            filename = os.path.basename(filepath)
-            if CB_RE.match(filename):
-                filesize = os.path.getsize(filepath)
-                if is_size(filesize, size):
-                    comics.append(get_file_info(filepath))
-
-        elif os.path.isdir(path):
-            if opts['recursive']:
-                for dirpath, dirnames, filenames in os.walk(path):
-                    alphanumeric_sort(filenames)
-                    for filename in filenames:
-                        if CB_RE.match(filename):
-                            filepath = os.path.join(dirpath, filename)
-                            filesize = os.path.getsize(filepath)
-                            if is_size(filesize, size):
-                                comics.append(get_file_info(filepath))
-            else:
-                filenames = os.listdir(path)
-                alphanumeric_sort(filenames)
-                for filename in filenames:
-                    filepath = os.path.join(path, filename)
-                    if os.path.isfile(filepath) and CB_RE.match(filename):
-                        filesize = os.path.getsize(filepath)
-                        if is_size(filesize, size):
-                            comics.append(get_file_info(filepath))
+    try:
+        for path in path_args:
+            path = os.path.realpath(path)
+
+            if os.path.isdir(path):
+                for entry in walk_dir(path, opts['recursive'], ordered):
+                    if CB_RE.match(entry.name):
+                        st = get_stat(entry)
+                        if st is not None:
+                            yield get_file_info(entry.path, st)
+
+            elif CB_RE.match(os.path.basename(path)):
+                entry = DirEntry(os.path.dirname(path), os.path.basename(path))
+                st = get_stat(entry)
+                if st is not None:
+                    yield get_file_info(path, st)
+    finally:
+        if index is not None:
+            index.close()
 
-    return comics
+def get_comics(path_args, opts, size=None):
+    """Returns list of comic archives for given path arguments"""
+    return list(iter_comics(path_args, opts, size, True))
 
 def get_images(dirname):
     """Returns list of images within archive"""
@@ -178,6 +353,26 @@ def get_images(dirname):
         sys.stderr.write('Error: %s\n' % str(err))
         return None
 
+def get_members(names):
+    """Returns list of images within archive member <names>"""
+    dirs = {}
+    for name in names:
+        if not name.endswith('/'):
+            dirname, filename = posixpath.split(name)
+            dirs.setdefault(dirname, []).append(filename)
+    images = []
+    dirnames = dirs.keys()
+    alphanumeric_sort(dirnames)
+    for dirname in dirnames:
+        filenames = dirs[dirname]
+        cover = guess_cover(filenames)
+        for filename in filenames:
+            if IMG_RE.match(filename):
+                basename, fileext = os.path.splitext(filename)
+                fullpath = posixpath.join(dirname, filename)
+                images.append((filename, fullpath, basename, fileext, cover))
+    return images
+
 def guess_cover(files):
     """Returns the filename within <files> that is the most likely to be
     the cover of an archive.
@@ -192,16 +387,20 @@ def guess_cover(files):
         return images[0]
     return None
 
+def alphanumeric_key(s):
+    """Returns sort key for alphanumeric sort of string <s>"""
+    def _format_substring(s):
+        if s.isdigit():
+            return int(s)
+        return s.lower()
+    return map(_format_substring, REC_RE.findall(s))
+
 def alphanumeric_sort(filenames):
     """Do an in-place alphanumeric sort of the strings in <filenames>,
     such that for an example "1.jpg", "2.jpg", "10.jpg" is a sorted
     ordering.
     """
-    def _format_substring(s):
-        if s.isdigit():
-            return int(s)
-        return s.lower()
-    filenames.sort(key=lambda s: map(_format_substring, REC_RE.findall(s)))
+    filenames.sort(key=alphanumeric_key)
 
 def filesizeformat(bytes, precision=2):
     """Returns a humanized string for a given amount of bytes"""
@@ -217,215 +416,700 @@ def filesizeformat(bytes, precision=2):
     )
 
 def unpack_archive(fullpath, filetype, filename):
-    if filetype == 'ZIP':
-        try:
-            tempdir = tempfile.mkdtemp(filename)
-            zip = zipfile.ZipFile(fullpath, 'r')
-            zip.extractall(tempdir)
-            return tempdir
-        except Exception, err:
-            log.Warn('Error extracting %s file %s: %s' % (
-                filetype, fullpath, str(err)))
-    elif filetype == 'RAR':
-        try:
-            tempdir = tempfile.mkdtemp(filename)
-            p = Popen([APPS['rar'], 'x', fullpath, tempdir],
-                    stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                    shell=False, startupinfo=startupinfo)
-            out = p.communicate()
-            if out[1] != '':
-                log.Warn('Error extracting %s file %s: %s' % (
-                    filetype, fullpath, out[1]))
-            else:
-                return tempdir
-        except Exception, err:
-            log.Warn('Error extracting %s file %s: %s' % (
-                filetype, fullpath, str(err)))
+    tempdir = tempfile.mkdtemp(filename)
+    try:
+        extractor = Extractor(fullpath, filetype)
+        extractor.extractall(tempdir)
+        extractor.close()
+        return tempdir
+    except Exception, err:
+        log.Warn('Error extracting %s file %s: %s' % (
+            filetype, fullpath, str(err)))
+    except KeyboardInterrupt:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        raise
+    shutil.rmtree(tempdir, ignore_errors=True)
     return None
 
-def pack_archive(tempdir, filetype, filepath):
+def extract_cover(fullpath, filetype):
+    """Returns (cover, fileobj) of archive <fullpath>, cover is guessed
+    from the member list and only that member is extracted, in memory.
+    Returns (None, None) if archive has no images.
+    """
+    extractor = Extractor(fullpath, filetype)
+    try:
+        cover = guess_cover(list(extractor.get_files()))
+        if cover is None:
+            return None, None
+        return cover, extractor.extract(cover)
+    finally:
+        extractor.close()
+
+def zip_compress(zinfo, data, level=6):
+    """Sets compression and sizes of member <zinfo> for <data> and
+    returns data as it will be written to archive. Already compressed
+    images are stored, everything else is deflated with <level>.
+    """
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    if level == 0 or not data or STORED_RE.match(zinfo.filename):
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = co.compress(data) + co.flush()
+    zinfo.compress_size = len(data)
+    return data
+
+def zip_append(zip, zinfo, data):
+    """Appends member <zinfo> with data returned by zip_compress to <zip>"""
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+            zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if zip64 and not zip._allowZip64:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+    zinfo.flag_bits &= ~0x08
+    zinfo.header_offset = zip.fp.tell()
+    zip._writecheck(zinfo)
+    zip._didModify = True
+    zip.fp.write(zinfo.FileHeader(zip64))
+    zip.fp.write(data)
+    zip.fp.flush()
+    zip.filelist.append(zinfo)
+    zip.NameToInfo[zinfo.filename] = zinfo
+
+def zip_write(zip, zinfo, data, level=6):
+    """Writes <data> as member <zinfo> of <zip>"""
+    zip_append(zip, zinfo, zip_compress(zinfo, data, level))
+
+def zip_read(args):
+    """Reads and compresses file for archive, used as thread pool worker"""
+    fullpath, arcname, level = args
+    st = os.stat(fullpath)
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(st[ST_MTIME])[:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+    fd = open(fullpath, 'rb')
     try:
-        cwd = os.getcwd()
-        os.chdir(tempdir)
-    except IOError:
-        pass
+        return zinfo, zip_compress(zinfo, fd.read(), level)
+    finally:
+        fd.close()
+
+def ordered_imap(pool, func, iterable, window):
+    """Same as pool.imap, but keeps at most <window> results in memory"""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def pack_archive(tempdir, filetype, filepath, level=6, jobs=1):
     basename = os.path.basename(filepath)
     if filetype == 'ZIP':
+        pool = None
         try:
-            zip = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED)
+            files = []
             for dirpath, dirnames, filenames in os.walk(tempdir):
                 for filename in filenames:
-                    relpath = os.path.relpath(os.path.join(dirpath, filename))
-                    zip.write(relpath)
+                    fullpath = os.path.join(dirpath, filename)
+                    arcname = os.path.relpath(fullpath, tempdir).replace(os.sep, '/')
+                    files.append((fullpath, arcname, level))
+
+            if jobs > 1 and len(files) > 1:
+                pool = ThreadPool(min(jobs, len(files)))
+                members = ordered_imap(pool, zip_read, files, jobs * 2)
+            else:
+                members = itertools.imap(zip_read, files)
+
+            zip = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED)
+            for zinfo, data in members:
+                zip_append(zip, zinfo, data)
             zip.close()
-            os.chdir(cwd)
             return True
         except Exception, err:
             log.Warn('Error packing %s file %s: %s' % (
                 filetype, basename, str(err)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
     elif filetype == 'RAR':
         try:
             p = Popen([APPS['rar'], 'a', '-r', filepath, '*'],
-                    stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=tempdir,
                     shell=False, startupinfo=startupinfo)
             out = p.communicate()
-            if out[1] != '':
+            if out[1] != '' or p.returncode != 0:
                 log.Warn('Error packing %s file %s: %s' % (
-                    filetype, basename, out[1]))
+                    filetype, basename, out[1] or 'exit status %d' % p.returncode))
             else:
-                os.chdir(cwd)
                 return True
         except Exception, err:
             log.Warn('Error packing %s file %s: %s' % (
                 filetype, basename, str(err)))
     return False
 
-def image_color(fullpath):
-    p = Popen([APPS['identify'], '-format', '%[colorspace]', fullpath],
+_processes = set()
+_processes_lock = threading.Lock()
+
+def track_process(p, running=True):
+    """Adds image process <p> to running processes, or removes it"""
+    with _processes_lock:
+        if running:
+            _processes.add(p)
+        else:
+            _processes.discard(p)
+    return p
+
+def kill_processes():
+    """Kills all running image processes started by this process"""
+    with _processes_lock:
+        processes = list(_processes)
+    for p in processes:
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+def image_identify(fullpath, data=None):
+    """Returns (colorspace, width, height, format, depth) of first frame
+    of image reported by one identify process, or None on error.
+    """
+    p = track_process(Popen([APPS['identify'], '-format', '%[colorspace] %w %h %m %z\\n', fullpath],
             stdin=PIPE, stdout=PIPE, stderr=PIPE,
-            shell=False, startupinfo=startupinfo)
-    stdout, stderr = p.communicate()
-    if stderr != '':
+            shell=False, startupinfo=startupinfo))
+    try:
+        stdout, stderr = p.communicate(data)
+    finally:
+        track_process(p, False)
+    fields = stdout.split('\n')[0].split()
+    if stderr != '' or len(fields) != 5:
         log.Warn('Error identifying file %s: %s\n' % (fullpath, stderr.strip()))
-        return False
-    return stdout.strip()
-
-def image_scale(fullpath, opts):
-    command = [APPS['mogrify'], '-quality', str(opts['quality']),
-            '-scale', str(opts['scale']), fullpath]
-    p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-            shell=False, startupinfo=startupinfo)
-    out = p.communicate()
-    if out[1] != '':
-        log.Warn('Error converting file %s: %s' % (fullpath, out[1]))
-        return False
-    return True
-
-def image_level(fullpath, opts):
-    command = [APPS['mogrify'], '-level', str(opts['level']), fullpath]
-    p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-            shell=False, startupinfo=startupinfo)
-    out = p.communicate()
-    if out[1] != '':
-        log.Warn('Error converting file %s: %s' % (fullpath, out[1]))
-        return False
-    return True
-
-def image_bmp(image, opts):
-    filename, fullpath, basename, fileext, cover = image
-    if opts['cover'] and filename == cover:
-        depth, colors = 8, 256
-    elif opts['bmp-8']:
-        depth, colors = 8, 256
-    elif opts['bmp-4']:
-        depth, colors = 4, 16
-
-    command = [APPS['convert'], fullpath, '+matte',
+        return None
+    color, width, height, fmt, depth = fields
+    if 'RGB' in color:
+        color = 'RGB'
+    return color, int(width), int(height), fmt, int(depth)
+
+class PageInfo:
+    """PageInfo holds colorspace, width, height, format and bit depth of
+    a page. Nothing is read until a value is asked for, then the image
+    header is parsed once, PIL and identify are used only if format is
+    not known to probe module.
+    """
+    FIELDS = ('colorspace', 'width', 'height', 'format', 'depth')
+
+    def __init__(self, source, data=None):
+        """Setup info for page file <source> or page <data>"""
+        self.source = source
+        self.data = data
+        self._info = None
+
+    def get(self, field):
+        """Returns value of <field>, or None if page can not be read"""
+        if self._info is None:
+            self._info = self._read() or (None,) * len(self.FIELDS)
+        return self._info[self.FIELDS.index(field)]
+
+    def size(self):
+        """Returns (width, height) of page"""
+        return self.get('width'), self.get('height')
+
+    def _read(self):
+        try:
+            if self.data is not None:
+                info = probe.probe(self.data)
+            else:
+                info = probe.probe_file(self.source)
+            if info is not None:
+                return info
+        except EnvironmentError:
+            pass
+        if imaging.available():
+            try:
+                if self.data is not None:
+                    return imaging.header_info(cStringIO.StringIO(self.data))
+                return imaging.header_info(self.source)
+            except (EnvironmentError, ValueError):
+                pass
+        return image_identify(self.source, self.data)
+
+def image_convert(fullpath, newpath, args, data=None):
+    command = [APPS['convert'], fullpath] + args + [newpath]
+    p = track_process(Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+            shell=False, startupinfo=startupinfo))
+    try:
+        stdout, stderr = p.communicate(data)
+    finally:
+        track_process(p, False)
+    if stderr != '':
+        log.Warn('Error converting file %s: %s' % (fullpath, stderr))
+        return None
+    return stdout
+
+def image_bmp(fullpath, args, depth, colors, data=None):
+    command = [APPS['convert'], fullpath] + args + ['+matte',
             '-depth', str(depth),
             '-colors', str(colors),
             'ppm:-']
+    convert = bmp = None
     try:
-        convert = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                shell=False, startupinfo=startupinfo)
-        bmp = Popen([APPS['ppmtobmp'], '-bpp', str(depth)],
+        convert = track_process(Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                shell=False, startupinfo=startupinfo))
+        bmp = track_process(Popen([APPS['ppmtobmp'], '-bpp', str(depth)],
                 stdin=convert.stdout, stdout=PIPE, stderr=PIPE,
-                shell=False, startupinfo=startupinfo)
+                shell=False, startupinfo=startupinfo))
+        convert.stdout.close()
+        if data is not None:
+            convert.stdin.write(data)
+        convert.stdin.close()
         stdout, stderr = bmp.communicate()
+        convert.wait()
         if len(stdout) > 0:
-            newpath = os.path.join(
-                    os.path.dirname(fullpath), '%s.bmp' % basename)
-            newfile = open(newpath, 'wb')
-            newfile.write(stdout)
-            newfile.close()
-            if fileext.lower() != '.bmp':
-                os.unlink(fullpath)
+            return stdout
+        return None
+    except EnvironmentError:
+        return None
+    finally:
+        for p in (convert, bmp):
+            if p is not None:
+                track_process(p, False)
+
+class Pipeline:
+    """Pipeline is the chain of operations built from options that is
+    run on every page, each page is decoded, transformed and encoded
+    in a single pass. Scale and level options are checked when pipeline
+    is created, ValueError is raised if they are not valid. Scale is
+    checked only for PIL engine, ImageMagick gets geometry unchanged.
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self.exclude = [] if not opts['exclude'] else opts['exclude']
+        self.quality = opts['quality']
+        self.scale = None
+        if opts['scale'] != '100%' or opts['quality'] != '0':
+            self.scale = opts['scale']
+        self.level = opts['level'] or None
+        if opts['bmp-4'] or opts['bmp-8']:
+            self.format = '.bmp'
+        elif opts['jpeg']:
+            self.format = '.jpg'
+        elif opts['png']:
+            self.format = '.png'
+        else:
+            self.format = None
+        self.palette = opts.get('palette') or 'page'
+        self.palettes = {}
+        if self.scale is not None and opts['engine'] == 'pil' and imaging.available():
+            imaging.scale_size(self.scale, (100, 100))
+        if self.level is not None:
+            imaging.level_values(self.level)
+
+    def prepare(self, sources):
+        """Computes palettes shared by all BMP pages of archive, <sources>
+        are page file names or file objects.
+        """
+        if self.format != '.bmp' or self.palette == 'page' or not imaging.available():
+            return
+        colors = set()
+        if self.opts['bmp-8'] or self.opts['cover']:
+            colors.add(256)
+        if self.opts['bmp-4']:
+            colors.add(16)
+        mosaic = None
+        if self.palette == 'archive':
+            mosaic = imaging.mosaic(sources)
+        for n in colors:
+            if self.palette == 'gray':
+                self.palettes[n] = imaging.gray_palette(n)
+            elif mosaic is not None:
+                self.palettes[n] = imaging.sample_palette(mosaic, n)
+
+    def needs_scale(self, info):
+        """Returns False if scaling would not change page size"""
+        if self.scale is None:
+            return False
+        if self.quality != '0' or info.get('width') is None:
+            return True
+        try:
+            return imaging.scale_size(self.scale, info.size()) != info.size()
+        except ValueError:
+            return True
+
+    def plan(self, image, filenum, info):
+        """Returns (target, operations) for page, operations are None
+        if page is left as it is.
+        """
+        operations = self.operations(info)
+        target = self.target(image, filenum, info)
+        if not operations and target is None:
+            return target, None
+        return target, operations
+
+    def operations(self, info):
+        """Returns list of (operation, argument) for page with
+        given PageInfo.
+        """
+        operations = []
+        if self.needs_scale(info):
+            operations.append(('scale', self.scale))
+        if self.level and info.get('colorspace') != 'RGB':
+            operations.append(('level', self.level))
+        return operations
+
+    def target(self, image, filenum, info):
+        """Returns extension of output file, or None if page keeps
+        its format.
+        """
+        filename, fullpath, basename, fileext, cover = image
+        if str(filenum) in self.exclude:
+            return None
+        if self.opts['nocover'] and filename == cover:
+            return None
+        if self.opts['norgb'] and info.get('colorspace') == 'RGB':
+            return None
+        return self.format
+
+    def bmp_depth(self, image):
+        """Returns BMP (depth, colors) for page"""
+        filename, fullpath, basename, fileext, cover = image
+        if self.opts['cover'] and filename == cover:
+            return 8, 256
+        elif self.opts['bmp-8']:
+            return 8, 256
+        return 4, 16
+
+    def newpath(self, image, target):
+        """Returns path of converted page file"""
+        filename, fullpath, basename, fileext, cover = image
+        if target is None:
+            return fullpath
+        return os.path.join(
+                os.path.dirname(fullpath), '%s%s' % (basename, target))
+
+    def membername(self, image, target):
+        """Returns archive member name of converted page"""
+        filename, fullpath, basename, fileext, cover = image
+        if target is None:
+            return fullpath
+        return posixpath.join(
+                posixpath.dirname(fullpath), '%s%s' % (basename, target))
+
+    def finish(self, image, target):
+        """Removes original page if it was converted to another file"""
+        filename, fullpath, basename, fileext, cover = image
+        if target is not None and fileext.lower() != target:
+            os.unlink(fullpath)
+
+class MagickEngine:
+    """MagickEngine converts pages with ImageMagick and Netpbm tools,
+    all operations on page are done with one convert process.
+    """
+    name = 'magick'
+
+    def _args(self, pipeline, image, filenum, source, data=None):
+        """Returns (target, args) for page, args are None if page
+        is left as it is.
+        """
+        target, operations = pipeline.plan(image, filenum, PageInfo(source, data))
+        if operations is None:
+            return target, None
+
+        args = []
+        for operation, arg in operations:
+            args += ['-%s' % operation, str(arg)]
+        if pipeline.quality != '0':
+            args += ['-quality', str(pipeline.quality)]
+        return target, args
+
+    def run(self, pipeline, image, filenum):
+        """Converts page file in place"""
+        filename, fullpath, basename, fileext, cover = image
+        target, args = self._args(pipeline, image, filenum, fullpath)
+        if args is None:
+            return True
+
+        newpath = pipeline.newpath(image, target)
+        if target == '.bmp':
+            depth, colors = pipeline.bmp_depth(image)
+            output = image_bmp(fullpath, args, depth, colors)
+            if output is not None:
+                newfile = open(newpath, 'wb')
+                newfile.write(output)
+                newfile.close()
+        else:
+            output = image_convert(fullpath, newpath, args)
+        if output is None:
+            return False
+        pipeline.finish(image, target)
         return True
-    except OSError:
-        return False
 
-def image_jpeg(image, opts):
-    filename, fullpath, basename, fileext, cover = image
-    newpath = os.path.join(
-            os.path.dirname(fullpath), '%s.jpg' % basename)
-    command = [APPS['convert'], fullpath, newpath]
-    p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-            shell=False, startupinfo=startupinfo)
-    out = p.communicate()
-    if out[1] != '':
-        log.Warn('Error converting file %s: %s' % (fullpath, out[1]))
-        return False
-    if fileext.lower() != '.jpg':
-        os.unlink(fullpath)
-    return True
-
-def image_png(image, opts):
-    filename, fullpath, basename, fileext, cover = image
-    newpath = os.path.join(
-            os.path.dirname(fullpath), '%s.png' % basename)
-    command = [APPS['convert'], fullpath, newpath]
-    p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-            shell=False, startupinfo=startupinfo)
-    out = p.communicate()
-    if out[1] != '':
-        log.Warn('Error converting file %s: %s' % (fullpath, out[1]))
-        return False
-    if fileext.lower() != '.png':
-        os.unlink(fullpath)
-    return True
+    def run_data(self, pipeline, image, filenum, data):
+        """Converts page from <data>, returns (name, data) of converted
+        page, original page is returned on error.
+        """
+        filename, fullpath, basename, fileext, cover = image
+        target, args = self._args(pipeline, image, filenum, '-', data)
+        if args is None:
+            return fullpath, data
+
+        if target == '.bmp':
+            depth, colors = pipeline.bmp_depth(image)
+            output = image_bmp('-', args, depth, colors, data)
+        else:
+            output = image_convert('-', '%s:-' % (target or fileext.lower())[1:], args, data)
+        if not output:
+            return fullpath, data
+        return pipeline.membername(image, target), output
+
+class PILEngine:
+    """PILEngine decodes every page that has to be converted once and
+    runs all operations in memory, pages are encoded in process.
+    """
+    name = 'pil'
+
+    def _transform(self, operations, im):
+        """Returns image with <operations> applied"""
+        for operation, arg in operations:
+            if operation == 'scale':
+                im = imaging.scale(im, arg)
+            elif operation == 'level':
+                im = imaging.level(im, arg)
+        return im
+
+    def _encode(self, pipeline, image, target, im, fmt, fileobj):
+        if target == '.bmp':
+            depth, colors = pipeline.bmp_depth(image)
+            if pipeline.palettes.get(colors) is None:
+                im = imaging.quantize_palette(im, colors)
+            elif pipeline.palette == 'gray':
+                im = imaging.map_gray(im, colors)
+            else:
+                im = imaging.map_palette(im, pipeline.palettes[colors])
+            imaging.save_bmp(im, fileobj, depth)
+        else:
+            fmt = imaging.FORMATS.get(target, fmt)
+            imaging.save_image(im, fileobj, fmt, pipeline.quality)
+
+    def run(self, pipeline, image, filenum):
+        """Converts page file in place, converted page is written to
+        disk while it is encoded.
+        """
+        filename, fullpath, basename, fileext, cover = image
+        partpath = None
+        try:
+            target, operations = pipeline.plan(image, filenum, PageInfo(fullpath))
+            if operations is None:
+                return True
+            im, fmt = imaging.open_image(fullpath)
+            im = self._transform(operations, im)
+
+            newpath = pipeline.newpath(image, target)
+            partpath = newpath + '.part'
+            newfile = open(partpath, 'wb')
+            try:
+                self._encode(pipeline, image, target, im, fmt, newfile)
+            finally:
+                newfile.close()
+            if os.name == 'nt' and os.path.exists(newpath):
+                os.unlink(newpath)
+            os.rename(partpath, newpath)
+            pipeline.finish(image, target)
+            return True
+        except (EnvironmentError, ValueError), err:
+            log.Warn('Error converting file %s: %s' % (fullpath, str(err)))
+            if partpath is not None and os.path.exists(partpath):
+                os.unlink(partpath)
+            return False
+
+    def run_data(self, pipeline, image, filenum, data):
+        """Converts page from <data>, returns (name, data) of converted
+        page, original page is returned on error.
+        """
+        filename, fullpath, basename, fileext, cover = image
+        try:
+            target, operations = pipeline.plan(image, filenum, PageInfo('-', data))
+            if operations is None:
+                return fullpath, data
+            im, fmt = imaging.open_image(cStringIO.StringIO(data))
+            im = self._transform(operations, im)
+
+            output = cStringIO.StringIO()
+            self._encode(pipeline, image, target, im, fmt, output)
+            return pipeline.membername(image, target), output.getvalue()
+        except (EnvironmentError, ValueError), err:
+            log.Warn('Error converting file %s: %s' % (fullpath, str(err)))
+            return fullpath, data
+
+ENGINES = {'magick': MagickEngine, 'pil': PILEngine}
+
+def get_engine(name):
+    """Returns image engine instance for given name, falls back to
+    ImageMagick if PIL is not available.
+    """
+    if name == 'pil' and not imaging.available():
+        log.Warn('PIL is not available, using ImageMagick')
+        name = 'magick'
+    return ENGINES.get(name, MagickEngine)()
+
+class Cancelled(Exception):
+    """Raised when conversion is cancelled"""
+
+def pool_init():
+    """Pool worker initializer, worker gets its own process group so it
+    can be killed together with its convert processes.
+    """
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+
+def kill_pool(pool):
+    """Kills pool workers, with their process groups if possible"""
+    if hasattr(os, 'killpg'):
+        for proc in pool._pool:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+    pool.terminate()
+    pool.join()
 
-def convert_images(tempdir, opts, parent=None, row=None):
-    exclude = [] if not opts['exclude'] else opts['exclude']
+def pool_results(results, cancel=None, timeout=0.2):
+    """Yields items of pool <results> iterator, <cancel> event is checked
+    every <timeout> seconds and Cancelled is raised when it is set.
+    """
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        try:
+            yield results.next(timeout)
+        except multiprocessing.TimeoutError:
+            pass
+        except StopIteration:
+            return
+
+def convert_image(args):
+    """Converts one page, used as process pool worker"""
+    name, pipeline, image, filenum = args
+    return get_engine(name).run(pipeline, image, filenum)
+
+def convert_data(args):
+    """Converts and compresses one page in memory, used as process pool
+    worker. Returns (zinfo, data) to be written with zip_append.
+    """
+    name, pipeline, image, filenum, data, date_time, level = args
+    arcname, data = get_engine(name).run_data(pipeline, image, filenum, data)
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = 0644 << 16L
+    return zinfo, zip_compress(zinfo, data, level)
+
+def convert_images(tempdir, opts, progress=None, cancel=None):
+    """Converts pages in <tempdir>, returns True on success. <cancel>
+    event is checked between pages, when it is set pool is killed and
+    False is returned. Image processes of the page being converted in
+    this process are killed with kill_processes().
+    """
     images = get_images(tempdir)
-    filenum = 0
+    engine = get_engine(opts['engine'])
+    pipeline = Pipeline(opts)
     maxrecords = len(images)
-    
-    def progress_update(filenum):
-        percent = float(filenum) / float(maxrecords) * 100
-        if opts['verbose']:
-            sys.stderr.write('Converting images [%d%%]\r' % int(percent))
-        if parent:
-            if row is not None:
-                rowcount = parent.model.rowCount()
-                prefix = "File %d of %d -" % (row+1, rowcount)
-            else:
-                prefix = ""
-            parent.progressBar.emit(SIGNAL("valueChanged(int)"), percent)
-            parent.emit(SIGNAL("show_message(PyQt_PyObject)"), "%s Converting images [%d%%]" % (prefix, int(percent)))
+    if progress is None:
+        progress = ProgressReporter(opts)
+    progress.start(maxrecords)
 
+    pool = None
     try:
-        for image in images:
-            filename, fullpath, basename, fileext, cover = image
-
-            if opts['scale'] != '100%' or opts['quality'] != '0':
-                image_scale(fullpath, opts)
-
-            if bool(opts['level']):
-                if image_color(fullpath) != 'RGB':
-                    image_level(fullpath, opts)
-
-            if str(filenum) in exclude:
-                progress_update(filenum)
-                filenum += 1
-                continue
-            if opts['nocover'] and filename == cover:
-                progress_update(filenum)
-                filenum += 1
-                continue
-            if opts['norgb'] and image_color(fullpath) == 'RGB':
-                progress_update(filenum)
-                filenum += 1
-                continue
-
-            if opts['bmp-4'] or opts['bmp-8']:
-                image_bmp(image, opts)
-            elif opts['jpeg']:
-                image_jpeg(image, opts)
-            elif opts['png']:
-                image_png(image, opts)
-
-            progress_update(filenum)
-            filenum += 1
+        pipeline.prepare([image[1] for image in images])
+        if PROCESS_POOL and opts['jobs'] > 1 and maxrecords > 1:
+            pool = multiprocessing.Pool(min(opts['jobs'], maxrecords),
+                    pool_init if cancel is not None else None)
+            tasks = [(engine.name, pipeline, image, filenum)
+                    for filenum, image in enumerate(images)]
+            results = pool.imap_unordered(convert_image, tasks)
+            for ret in pool_results(results, cancel):
+                progress.update()
+            pool.close()
+            pool.join()
+        else:
+            for filenum, image in enumerate(images):
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled()
+                engine.run(pipeline, image, filenum)
+                progress.update()
         return True
+    except (Cancelled, KeyboardInterrupt), err:
+        if pool is not None:
+            kill_pool(pool)
+        if isinstance(err, KeyboardInterrupt):
+            raise
     except Exception, err:
+        if pool is not None:
+            pool.terminate()
         log.Warn('Error converting file %s: %s' % (tempdir, str(err)))
     return False
+
+def convert_archive(fullpath, filepath, opts, progress=None, cancel=None):
+    """Converts ZIP archive <fullpath> to ZIP archive <filepath> without
+    temporary directory, pages are read from source archive, converted
+    in memory and written straight to the new archive. <cancel> event
+    is checked between pages, new archive is removed when it is set.
+    """
+    engine = get_engine(opts['engine'])
+    pipeline = Pipeline(opts)
+
+    pool = None
+    dst = None
+    try:
+        src = zipfile.ZipFile(fullpath, 'r')
+        dst = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED)
+        images = get_members(src.namelist())
+        maxrecords = len(images)
+        if progress is None:
+            progress = ProgressReporter(opts)
+        progress.start(maxrecords)
+        pipeline.prepare(cStringIO.StringIO(src.read(image[1])) for image in images)
+
+        pages = set([image[1] for image in images])
+        for info in src.infolist():
+            if info.filename not in pages:
+                zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+                zinfo.external_attr = info.external_attr
+                zip_write(dst, zinfo, src.read(info.filename), opts['compress_level'])
+
+        tasks = ((engine.name, pipeline, image, filenum, src.read(image[1]),
+                src.getinfo(image[1]).date_time, opts['compress_level'])
+                for filenum, image in enumerate(images))
+        if PROCESS_POOL and opts['jobs'] > 1 and maxrecords > 1:
+            pool = multiprocessing.Pool(min(opts['jobs'], maxrecords),
+                    pool_init if cancel is not None else None)
+            results = pool_results(pool.imap(convert_data, tasks), cancel)
+        else:
+            results = itertools.imap(convert_data, tasks)
+
+        for zinfo, data in results:
+            zip_append(dst, zinfo, data)
+            progress.update()
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        dst.close()
+        src.close()
+        return True
+    except (Cancelled, KeyboardInterrupt), err:
+        if pool is not None:
+            kill_pool(pool)
+        if dst is not None:
+            dst.close()
+        if os.path.isfile(filepath):
+            os.unlink(filepath)
+        if isinstance(err, KeyboardInterrupt):
+            raise
+    except Exception, err:
+        if pool is not None:
+            pool.terminate()
+        log.Warn('Error converting file %s: %s' % (fullpath, str(err)))
+        if os.path.isfile(filepath):
+            os.unlink(filepath)
+    return False
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Author: Milan Nikolic <gen2brain@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+
+from comicutils import imaging
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def load_levels():
+    """Returns dict of -level argument and expected output values"""
+    levels = {}
+    for line in open(os.path.join(DATA_DIR, 'level.txt')):
+        if line.startswith('#') or not line.strip():
+            continue
+        fields = line.split()
+        levels[fields[0]] = [int(v) for v in fields[1:]]
+    return levels
+
+class LevelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.levels = load_levels()
+
+    def test_fixtures(self):
+        for level in ['10%', '10%,90%', '0,65535,2.0', '50%,50%']:
+            self.assertEqual(len(self.levels[level]), 256)
+
+    def test_level_table(self):
+        for level, expected in self.levels.items():
+            self.assertEqual(imaging.level_table(level), expected, level)
+
+    def test_black_only(self):
+        self.assertEqual(imaging.level_values('10%'),
+                imaging.level_values('10%,90%'))
+
+    @unittest.skipUnless(imaging.available(), 'PIL is not installed')
+    def test_level_image(self):
+        im = imaging.Image.new('L', (256, 1))
+        im.putdata(range(256))
+        self.assertEqual(list(imaging.level(im, '10%').getdata()),
+                self.levels['10%'])
+
+if __name__ == '__main__':
+    unittest.main()